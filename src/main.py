@@ -1,15 +1,20 @@
 import os
 import time
-import json
+import asyncio
+import functools
+import hashlib
+import secrets
+import threading
 from typing import Optional
 import boto3
-from datetime import datetime
+import orjson
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import streamlit as st
 from dotenv import load_dotenv
 from PIL import Image
 import io
-from PyPDF2 import PdfReader
-import tempfile
+from pypdf import PdfReader
 
 # Load environment variables
 load_dotenv()
@@ -22,22 +27,156 @@ if not S3_BUCKET:
 AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
 MODEL_ID = "amazon.nova-micro-v1:0"
 
-def upload_to_s3(file_obj, bucket, key):
-    """Upload a file to S3"""
-    s3_client = boto3.client('s3', region_name=AWS_REGION)
+# Static parts of the Bedrock request, built once; per-call code only fills
+# in the user message and inference parameters
+_BEDROCK_SYSTEM = [
+    {
+        "text": "You are a helpful assistant that analyzes text from scanned documents"
+    }
+]
+
+# The request skeleton is pre-serialized into byte segments at module load,
+# so each call only serializes the two dynamic fields and concatenates
+_BODY_PREFIX = (
+    b'{"schemaVersion":"messages-v1","system":'
+    + orjson.dumps(_BEDROCK_SYSTEM)
+    + b',"messages":'
+)
+_BODY_MID = b',"inferenceConfig":'
+_BODY_SUFFIX = b'}'
+
+# Documents up to this size are sent inline to Textract (sync limit is 10 MB;
+# keep headroom), skipping the S3 round-trip on the critical path
+SYNC_BYTES_LIMIT = 5 * 1024 * 1024
+
+# Longest edge to keep when downscaling image uploads; Textract accuracy
+# plateaus around 2-3 MP for letter-size pages
+MAX_IMAGE_EDGE = 2500
+
+# Multipart upload settings: large documents are split into parallel part
+# PUTs instead of a single-stream upload
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=25 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# Shared client settings: a large connection pool for concurrent transfers
+# and adaptive retries to ride out Textract/Bedrock throttling
+_BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+)
+
+class _TokenBucket:
+    """Thread-safe token bucket; each Streamlit session runs its own event
+    loop on its own thread, so the shared limiter must not rely on asyncio"""
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block the calling thread until a token is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+# Token bucket smoothing Textract bursts into the sync TPS quota, so
+# concurrent sessions back off instead of tripping
+# ProvisionedThroughputExceededException
+_TEXTRACT_LIMITER = _TokenBucket(rate=5.0, capacity=5)
+
+_SESSION = boto3.session.Session(region_name=AWS_REGION)
+
+# Completed analyses keyed by (prompt, text, params) hash; streamed responses
+# can't go through st.cache_data, so the cache is kept explicitly and bounded
+# by evicting the oldest insertion
+_BEDROCK_CACHE = {}
+_BEDROCK_CACHE_MAX = 1024
+
+@st.cache_resource(show_spinner=False)
+def get_client(service_name):
+    """Return a cached boto3 client so connection pools are reused across reruns"""
+    return _SESSION.client(service_name, config=_BOTO_CONFIG)
+
+def _pdf_page_count(pdf_reader):
+    """Read the page count from the /Pages tree without loading page objects"""
+    try:
+        return int(pdf_reader.trailer["/Root"]["/Pages"]["/Count"])
+    except (KeyError, TypeError, ValueError):
+        return len(pdf_reader.pages)
+
+def downscale_image(image_bytes, file_extension):
+    """
+    Downscale oversized image uploads before they hit S3 and Textract.
+
+    Phone-camera scans are often 10-20 MP; shrinking them to MAX_IMAGE_EDGE
+    cuts upload bytes severalfold without hurting OCR quality. Returns the
+    (possibly re-encoded JPEG) bytes and the matching file extension.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        if max(image.size) <= MAX_IMAGE_EDGE:
+            return image_bytes, file_extension
+
+        image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue(), "jpg"
+    except Exception:
+        # Let Textract deal with anything Pillow can't decode
+        return image_bytes, file_extension
+
+def _embedded_pdf_text(pdf_bytes):
+    """
+    Return the PDF's embedded text layer, or None if it looks scanned.
+
+    Born-digital PDFs already carry their text, so OCR adds nothing; a page
+    with a non-trivial text layer and no image XObjects can skip Textract.
+    """
+    try:
+        page = PdfReader(io.BytesIO(pdf_bytes), strict=False).pages[0]
+        text = page.extract_text() or ""
+        if len(text.strip()) > 50 and not page.images:
+            return text
+    except Exception:
+        pass
+    return None
+
+@st.cache_data(show_spinner=False)
+def extract_pdf_text(pdf_bytes: bytes) -> str:
+    """Extract the first page's text, cached so reruns don't reparse the PDF"""
+    page = PdfReader(io.BytesIO(pdf_bytes), strict=False).pages[0]
+    return page.extract_text()
+
+async def upload_to_s3(file_obj, bucket, key):
+    """Upload a file to S3 without blocking the event loop"""
+    loop = asyncio.get_running_loop()
     try:
-        s3_client.upload_fileobj(file_obj, bucket, key)
+        await loop.run_in_executor(
+            None,
+            functools.partial(get_client("s3").upload_fileobj, file_obj, bucket, key, Config=S3_TRANSFER_CONFIG),
+        )
         return True
     except Exception as e:
         st.error(f"Error uploading to S3: {str(e)}")
         return False
 
-def invoke_bedrock_model(client: boto3.client, prompt: str, extracted_text: str) -> Optional[str]:
-    system_list = [
-        {
-            "text": "You are a helpful assistant that analyzes text from scanned documents"
-        }
-    ]
+def _build_request_body(prompt: str, extracted_text: str, params_tuple: tuple) -> bytes:
+    """Render the Bedrock messages-v1 request body around the static skeleton"""
+    max_new_tokens, temperature, top_p, top_k = params_tuple
 
     message_list = [
         {
@@ -49,90 +188,178 @@ def invoke_bedrock_model(client: boto3.client, prompt: str, extracted_text: str)
             ]
         }
     ]
-
     inf_params = {
-        "max_new_tokens": 1000,
-        "top_p": 0.9,
-        "top_k": 20,
-        "temperature": 0.7
+        "max_new_tokens": max_new_tokens,
+        "top_p": top_p,
+        "top_k": top_k,
+        "temperature": temperature
     }
 
-    request_body = {
-        "schemaVersion": "messages-v1",
-        "messages": message_list,
-        "system": system_list,
-        "inferenceConfig": inf_params
-    }
+    return b"".join((
+        _BODY_PREFIX,
+        orjson.dumps(message_list),
+        _BODY_MID,
+        orjson.dumps(inf_params),
+        _BODY_SUFFIX,
+    ))
 
-    try:
-        response = client.invoke_model(
+def bedrock_analyze(prompt: str, extracted_text: str, params_tuple: tuple) -> str:
+    """Invoke the Bedrock model without streaming (fallback path)"""
+    response = get_client("bedrock-runtime").invoke_model(
+        modelId=MODEL_ID,
+        body=_build_request_body(prompt, extracted_text, params_tuple),
+        contentType="application/json",
+        accept="application/json",
+    )
+
+    # Accumulate the body chunk by chunk as it arrives rather than blocking
+    # in a single read(), then hand the buffer to orjson in one go
+    buffer = bytearray()
+    for chunk in response['body'].iter_chunks():
+        buffer += chunk
+    response_body = orjson.loads(bytes(buffer))
+
+    if "output" in response_body:
+        message = response_body["output"]["message"]
+        if "content" in message and len(message["content"]) > 0:
+            return message["content"][0]["text"]
+    return ""
+
+async def _stream_bedrock_response(loop, prompt: str, extracted_text: str, params_tuple: tuple) -> str:
+    """Stream the model response, rendering tokens in the UI as they arrive"""
+    response = await loop.run_in_executor(
+        None,
+        functools.partial(
+            get_client("bedrock-runtime").invoke_model_with_response_stream,
             modelId=MODEL_ID,
-            body=json.dumps(request_body),
+            body=_build_request_body(prompt, extracted_text, params_tuple),
             contentType="application/json",
             accept="application/json",
-        )
+        ),
+    )
 
-        response_body = json.loads(response['body'].read())
-        
-        if "output" in response_body:
-            message = response_body["output"]["message"]
-            if "content" in message and len(message["content"]) > 0:
-                return message["content"][0]["text"]
-        return ""
-    
+    placeholder = st.empty()
+    pieces = []
+    try:
+        for event in response['body']:
+            chunk = orjson.loads(event['chunk']['bytes'])
+            delta = chunk.get("contentBlockDelta", {}).get("delta", {}).get("text")
+            if delta:
+                pieces.append(delta)
+                placeholder.markdown("".join(pieces))
+    finally:
+        # The accumulated text is rendered in the results pane instead; on a
+        # mid-stream failure this also clears the partial output so the
+        # fallback path doesn't render a duplicate answer below it
+        placeholder.empty()
+    return "".join(pieces)
+
+async def invoke_bedrock_model(prompt: str, extracted_text: str, params_tuple: tuple) -> Optional[str]:
+    cache_key = hashlib.blake2b(
+        "\x00".join((prompt, extracted_text, repr(params_tuple))).encode(),
+        digest_size=16,
+    ).digest()
+    cached = _BEDROCK_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        loop = asyncio.get_running_loop()
+        try:
+            result = await _stream_bedrock_response(loop, prompt, extracted_text, params_tuple)
+        except Exception:
+            # Streaming may be unavailable for the model or blocked by IAM;
+            # fall back to the buffered invoke_model path
+            result = await loop.run_in_executor(None, bedrock_analyze, prompt, extracted_text, params_tuple)
+        if len(_BEDROCK_CACHE) >= _BEDROCK_CACHE_MAX:
+            _BEDROCK_CACHE.pop(next(iter(_BEDROCK_CACHE)))
+        _BEDROCK_CACHE[cache_key] = result
+        return result
     except Exception as e:
         st.error(f"Error invoking model: {str(e)}")
         return ""
 
-def process_document(s3_key, custom_prompt):
+async def invoke_bedrock_many(prompts: list, extracted_text: str, params_tuple: tuple) -> list:
     """
-    Process document with Textract and Bedrock.
-    
+    Invoke the model for several prompt variants in parallel.
+
+    boto3's invoke_model blocks in the socket layer and releases the GIL, so
+    fanning the non-streaming calls out over the thread pool makes total
+    latency track the slowest call instead of the sum. Useful for A/B-testing
+    prompts or ensembling answers over the same extracted text.
+    """
+    loop = asyncio.get_running_loop()
+    return list(await asyncio.gather(
+        *(
+            loop.run_in_executor(None, bedrock_analyze, prompt, extracted_text, params_tuple)
+            for prompt in prompts
+        )
+    ))
+
+def _join_line_blocks(detect_text_output):
+    """Join LINE block text in a single pass, skipping redundant WORD blocks"""
+    return "\n".join(
+        block["Text"]
+        for block in detect_text_output["Blocks"]
+        if block.get("BlockType") == "LINE"
+    )
+
+@st.cache_data(show_spinner=False)
+def extract_text_cached(doc_bytes: bytes) -> str:
+    """Extract text with Textract, cached on the raw document bytes"""
+    detect_text_output = get_client("textract").detect_document_text(
+        Document={"Bytes": doc_bytes}
+    )
+    return _join_line_blocks(detect_text_output)
+
+async def process_document(file_bytes, s3_key, custom_prompt, inference_params):
+    """
+    Process the document with Textract and Bedrock, archiving it to S3.
+
+    Small documents are sent inline to Textract via Bytes, with the S3
+    upload running in the background purely for archival; only documents
+    above the synchronous size limit go through S3 first.
+
     Args:
-        s3_key (str): S3 object key of the uploaded document
+        file_bytes (bytes): Raw bytes of the uploaded document
+        s3_key (str): S3 object key for the uploaded document
         custom_prompt (str): Custom prompt for Bedrock analysis
-    
+        inference_params (tuple): (max_new_tokens, temperature, top_p, top_k)
+
     Returns:
         dict: Dictionary containing:
             - extracted_text: Text extracted from document
             - analysis_result: Analysis from Bedrock
             - textract_time: Time taken by Textract
             - bedrock_time: Time taken by Bedrock
+        or None if the upload failed.
     """
     try:
-        # Initialize AWS clients
-        textract_client = boto3.client("textract", region_name=AWS_REGION)
-        bedrock_client = boto3.client("bedrock-runtime", region_name=AWS_REGION)
-
-        document = {
-            "S3Object": {
-                "Bucket": S3_BUCKET,
-                "Name": s3_key,
-            }
-        }
+        loop = asyncio.get_running_loop()
 
-        # Process with Textract and measure time
-        textract_start = time.time()
-        with st.spinner('Processing document with Textract...'):
-            detect_text_output = textract_client.detect_document_text(Document=document)
-            extracted_text = "\n".join(
-                [block["Text"] for block in detect_text_output["Blocks"] if "Text" in block]
-            )
-        textract_time = time.time() - textract_start
+        extracted_text, textract_time, upload_task = await _extract_with_textract(
+            loop, file_bytes, s3_key
+        )
+        if extracted_text is None:
+            return None
 
         # Process with Bedrock and measure time
         bedrock_start = time.time()
         with st.spinner('Analyzing with Bedrock...'):
-            analysis_result = invoke_bedrock_model(bedrock_client, custom_prompt, extracted_text)
+            analysis_result = await invoke_bedrock_model(custom_prompt, extracted_text, inference_params)
         bedrock_time = time.time() - bedrock_start
-            
+
+        # Let the archival upload finish before the event loop closes
+        if upload_task is not None:
+            await upload_task
+
         return {
             "extracted_text": extracted_text,
             "analysis_result": analysis_result,
             "textract_time": textract_time,
             "bedrock_time": bedrock_time
         }
-    
+
     except Exception as e:
         st.error(f"Error processing document: {str(e)}")
         return {
@@ -142,6 +369,60 @@ def process_document(s3_key, custom_prompt):
             "bedrock_time": 0
         }
 
+async def _extract_with_textract(loop, file_bytes, s3_key):
+    """Run Textract on the document, returning (text, elapsed, upload_task)"""
+    upload_task = asyncio.ensure_future(
+        upload_to_s3(io.BytesIO(file_bytes), S3_BUCKET, s3_key)
+    )
+
+    # Born-digital PDFs skip OCR entirely; the archival upload still runs
+    if file_bytes[:5] == b"%PDF-":
+        embedded_text = await loop.run_in_executor(None, _embedded_pdf_text, file_bytes)
+        if embedded_text is not None:
+            return embedded_text, 0.0, upload_task
+
+    textract_start = time.time()
+    if len(file_bytes) <= SYNC_BYTES_LIMIT:
+        # Inline bytes: Textract reads the document straight from the
+        # request, so the upload only needs to finish before we return.
+        # The Bedrock client is warmed alongside so it is ready by the
+        # time Textract finishes
+        with st.spinner('Processing document with Textract...'):
+            await loop.run_in_executor(None, _TEXTRACT_LIMITER.acquire)
+            extracted_text, _ = await asyncio.gather(
+                loop.run_in_executor(None, extract_text_cached, file_bytes),
+                loop.run_in_executor(None, get_client, "bedrock-runtime"),
+            )
+    else:
+        # Too large for the sync Bytes path: Textract has to read the
+        # object back from S3, so wait for the upload to complete
+        with st.spinner('Uploading file to S3...'):
+            uploaded, textract_client, _ = await asyncio.gather(
+                upload_task,
+                loop.run_in_executor(None, get_client, "textract"),
+                loop.run_in_executor(None, get_client, "bedrock-runtime"),
+            )
+        if not uploaded:
+            return None, 0.0, None
+
+        document = {
+            "S3Object": {
+                "Bucket": S3_BUCKET,
+                "Name": s3_key,
+            }
+        }
+
+        with st.spinner('Processing document with Textract...'):
+            await loop.run_in_executor(None, _TEXTRACT_LIMITER.acquire)
+            detect_text_output = await loop.run_in_executor(
+                None,
+                functools.partial(textract_client.detect_document_text, Document=document),
+            )
+            extracted_text = _join_line_blocks(detect_text_output)
+    textract_time = time.time() - textract_start
+
+    return extracted_text, textract_time, upload_task
+
 def main():
     st.set_page_config(page_title="Document Analysis with AWS", layout="wide")
     
@@ -199,88 +480,84 @@ def main():
             help="Specify how you want the document to be analyzed"
         )
 
-        # Preview handling for different file types
+        # Preview handling for different file types; the upload is read into
+        # bytes once here and shared by the preview and processing paths
         if uploaded_file is not None:
+            file_bytes = uploaded_file.getvalue()
             file_type = uploaded_file.type
             if file_type == "application/pdf":
                 try:
-                    # Create a temporary file to store the PDF
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                        tmp_file.write(uploaded_file.getvalue())
-                        tmp_file.flush()  # Flush the file buffer
-                        tmp_file_path = tmp_file.name
-
-                    # Read PDF and check number of pages
-                    pdf_reader = PdfReader(tmp_file_path)
-                    num_pages = len(pdf_reader.pages)
-                    
+                    # Read the PDF straight from memory and check the page
+                    # count without materializing page objects
+                    pdf_reader = PdfReader(io.BytesIO(file_bytes), strict=False)
+                    num_pages = _pdf_page_count(pdf_reader)
+
                     if num_pages > 1:
                         st.error("Multi-page documents are not supported for this demonstration. Please upload a single-page document.")
                         uploaded_file = None
                     else:
                         st.write("PDF document preview:")
                         # Display the text content of the page
-                        page = pdf_reader.pages[0]
                         st.text_area(
                             label="PDF content",
-                            value=page.extract_text(),
+                            value=extract_pdf_text(file_bytes),
                             height=300,
                             disabled=True
                         )
-                    
-                    # Clean up the temporary file
-                    os.unlink(tmp_file_path)
-                    
+
                 except Exception as e:
                     st.error(f"Error processing PDF: {str(e)}")
                     uploaded_file = None
                     
             elif file_type.startswith('image/'):
                 st.write("Image preview:")
-                st.image(uploaded_file, caption="Preview of uploaded document", use_container_width=True)
+                st.image(file_bytes, caption="Preview of uploaded document", use_container_width=True)
 
     with col2:
         if uploaded_file and st.button("Process Document", type="primary"):
             total_start = time.time()
             
             file_extension = uploaded_file.name.split('.')[-1]
-            s3_key = f"uploads/{datetime.now().strftime('%Y%m%d_%H%M%S')}.{file_extension}"
+            if uploaded_file.type.startswith('image/'):
+                file_bytes, file_extension = downscale_image(file_bytes, file_extension)
 
-            with st.spinner('Uploading file to S3...'):
-                if upload_to_s3(uploaded_file, S3_BUCKET, s3_key):
-                    st.success("File uploaded successfully!")
-                    
-                    # Get results as a dictionary
-                    result = process_document(s3_key, custom_prompt)
-                    total_time = time.time() - total_start
-                    
-                    # Display metrics
-                    col1_metric, col2_metric, col3_metric = st.columns(3)
-                    with col1_metric:
-                        st.metric(label="Textract Processing Time", value=f"{result['textract_time']:.2f}s")
-                    with col2_metric:
-                        st.metric(label="Bedrock Analysis Time", value=f"{result['bedrock_time']:.2f}s")
-                    with col3_metric:
-                        st.metric(label="Total Processing Time", value=f"{total_time:.2f}s")
-                    
-                    # Display results
-                    st.subheader("Extracted Text")
-                    st.text_area(
-                        label="Text extracted from document",
-                        value=result['extracted_text'],
-                        height=200,
-                        key="extracted_text"
-                    )
-                    
-                    st.subheader("Analysis Result")
-                    st.text_area(
-                        label="AI analysis results",
-                        value=result['analysis_result'],
-                        height=200,
-                        key="analysis_result"
-                    )
-                else:
-                    st.error("Failed to upload file")
+            # Nanosecond timestamp plus a random suffix: no strftime cost and
+            # no silent overwrites when two uploads land in the same second
+            s3_key = f"uploads/{time.time_ns()}_{secrets.token_hex(4)}.{file_extension}"
+            inference_params = (max_new_tokens, temperature, top_p, top_k)
+
+            # Get results as a dictionary
+            result = asyncio.run(process_document(file_bytes, s3_key, custom_prompt, inference_params))
+            total_time = time.time() - total_start
+
+            if result is not None:
+                # Display metrics
+                col1_metric, col2_metric, col3_metric = st.columns(3)
+                with col1_metric:
+                    st.metric(label="Textract Processing Time", value=f"{result['textract_time']:.2f}s")
+                with col2_metric:
+                    st.metric(label="Bedrock Analysis Time", value=f"{result['bedrock_time']:.2f}s")
+                with col3_metric:
+                    st.metric(label="Total Processing Time", value=f"{total_time:.2f}s")
+
+                # Display results
+                st.subheader("Extracted Text")
+                st.text_area(
+                    label="Text extracted from document",
+                    value=result['extracted_text'],
+                    height=200,
+                    key="extracted_text"
+                )
+
+                st.subheader("Analysis Result")
+                st.text_area(
+                    label="AI analysis results",
+                    value=result['analysis_result'],
+                    height=200,
+                    key="analysis_result"
+                )
+            else:
+                st.error("Failed to upload file")
 
 if __name__ == "__main__":
     main()